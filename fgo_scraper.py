@@ -4,6 +4,16 @@ import json
 import re # 导入 re 以备后续可能的文本清理
 import os
 import random
+import argparse
+import hashlib
+import heapq
+import io
+import multiprocessing
+import stat
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 # --- 常量定义 ---
 FGO_WIKI_URL = "https://fgowiki.com/guide/petdetail"
@@ -16,6 +26,28 @@ OUTPUT_FILENAME = "fgo_output.json"
 UNMAPPED_SERVANTS_FILE = "unmapped_fgo_servants.json"
 UNUSED_BANGUMI_FILE = "unused_bangumi_entries.json"
 ALL_SERVANTS_FILE = "all_fgo_servants.json"
+SERVANT_ALIASES_FILE = "fgo_servant_aliases.json"
+MERGED_OUTPUT_FILENAME = "fgo_bangumi_data_merged.json"
+MERGE_PROVENANCE_FILE = "fgo_merge_provenance.json"
+# 合并时输出记录的字段顺序
+MERGE_FIELDS = ["稀有度", "职阶", "宝具色卡", "宝具类型", "获取途径"]
+# 视为“缺失”的字段值，合并时会被其他数据源的有效值覆盖
+UNKNOWN_FACET_VALUES = {"未知", "未知途径"}
+# 职阶与色卡图标资源
+ASSET_DIR = os.path.join("assets", "tag", "fgo")
+ASSET_URL_PREFIX = "/assets/tag/fgo"
+ASSET_ICON_GROUPS = ["Class", "Color"]
+ASSET_DIST_DIR = os.path.join(ASSET_DIR, "dist")
+ASSET_DIST_URL = f"{ASSET_URL_PREFIX}/dist"
+ASSET_MANIFEST_NAME = "manifest.json"
+ASSET_MANIFEST_FILE = os.path.join(ASSET_DIST_DIR, ASSET_MANIFEST_NAME)
+ASSET_SPRITE_NAME = "fgo-icons"
+ASSET_SPRITE_MAX_WIDTH = 1024
+ASSET_HASH_LENGTH = 10
+ICON_MODES = ["path", "hashed", "sprite"]
+# 并行解析Wiki表格时，大表格按此行数拆分为多个任务
+WIKI_ROWS_PER_TASK = 64
+_HTML_SCAN_PATTERN = re.compile(r'<!--|<(/?)(table|script|style)\b[^>]*>', re.I)
 # 禁用代理，解决连接问题
 PROXIES = {
     "http": None,
@@ -49,6 +81,105 @@ def get_soup(url_or_file, use_local=False):
         return None
 
 # --- 爬取逻辑 ---
+def parse_servant_row(cells):
+    """从表格行的单元格中提取从者数据，返回 (从者名称, 数据)"""
+    # 提取从者ID
+    servant_id = cells[0].get_text().strip()
+    
+    # 提取从者名称并标准化（替换中日文点为中文间隔号）
+    name_cell = cells[2]
+    name_cn = name_cell.find('a').get_text().strip() if name_cell.find('a') else ""
+    # 标准化名称：将"・"替换为"·"
+    name_cn = name_cn.replace("・", "·")
+    
+    # 提取宝具色卡和类型
+    np_cell = cells[3]
+    np_card_img = np_cell.find('img')
+    np_card = "未知"
+    if np_card_img and 'src' in np_card_img.attrs:
+        src = np_card_img['src']
+        if 'Arts' in src:
+            np_card = "Arts"
+        elif 'Buster' in src:
+            np_card = "Buster"
+        elif 'Quick' in src:
+            np_card = "Quick"
+    
+    np_type = np_cell.find('b').get_text().strip() if np_cell.find('b') else "未知"
+    
+    # 提取职阶
+    class_cell = cells[4]
+    class_img = class_cell.find('img')
+    servant_class = "未知"
+    class_rarity = "未知"
+    
+    if class_img and 'src' in class_img.attrs:
+        src = class_img['src']
+        class_match = re.search(r'(金|银|铜)卡(.+?)\.png', src)
+        if class_match:
+            rarity_prefix, class_name = class_match.groups()
+            servant_class = class_name
+            
+            # 根据图片URL中的前缀确定稀有度
+            if rarity_prefix == "金":
+                class_rarity = "5星"  # 假设金卡是5星
+            elif rarity_prefix == "银":
+                class_rarity = "3星"
+            elif rarity_prefix == "铜":
+                class_rarity = "1星"
+    
+    # 提取获取途径
+    obtain = cells[7].get_text().strip()
+    
+    return name_cn, {
+        "id": servant_id,
+        "稀有度": class_rarity,
+        "职阶": servant_class,
+        "宝具色卡": np_card,
+        "宝具类型": np_type,
+        "获取途径": obtain
+    }
+
+def parse_wiki_table(table, table_no, first_row_no=0):
+    """解析单个 wikitable，返回 ([(从者名称, 数据), ...], [错误信息, ...])
+
+    first_row_no 为 table 中第一行在原表格中的行号（表头为第0行），
+    用于按行分块解析时保持错误信息中的行号与原表格一致。
+    """
+    entries = []
+    errors = []
+    
+    # 查找所有行
+    rows = table.find_all('tr')
+    
+    for offset, row in enumerate(rows):
+        row_no = first_row_no + offset
+        # 跳过表头行
+        if row_no == 0:
+            continue
+        cells = row.find_all('td')
+        if len(cells) < 8:  # 确保有足够的单元格
+            continue
+            
+        try:
+            name_cn, details = parse_servant_row(cells)
+            # 只有当名称不为空时才添加
+            if name_cn:
+                entries.append((name_cn, details))
+        except Exception as e:
+            errors.append(f"解析从者行时出错 (第 {table_no} 个表格, 第 {row_no} 行): {e}")
+    
+    return entries, errors
+
+def _merge_wiki_entries(fgo_data, entries):
+    """按文档顺序合并解析结果，同名从者以后出现的为准"""
+    for name_cn, details in entries:
+        fgo_data[name_cn] = details
+        
+        # 打印一些已提取的从者数据
+        if len(fgo_data) <= 5 or len(fgo_data) % 50 == 0:
+            print(f"提取到从者: {name_cn} (ID: {details['id']}), 职阶: {details['职阶']}, 稀有度: {details['稀有度']}")
+
 def parse_fgo_wiki_html(soup):
     """从本地HTML文件的soup对象中解析从者数据"""
     print("开始解析FGO Wiki HTML数据...")
@@ -58,82 +189,11 @@ def parse_fgo_wiki_html(soup):
     print("查找从者表格数据...")
     tables = soup.find_all('table', class_="wikitable")
     
-    for table in tables:
-        # 查找所有行
-        rows = table.find_all('tr')
-        
-        # 跳过表头行
-        for row in rows[1:]:  # 从第二行开始
-            cells = row.find_all('td')
-            if len(cells) < 8:  # 确保有足够的单元格
-                continue
-                
-            try:
-                # 提取从者ID
-                servant_id = cells[0].get_text().strip()
-                
-                # 提取从者名称并标准化（替换中日文点为中文间隔号）
-                name_cell = cells[2]
-                name_cn = name_cell.find('a').get_text().strip() if name_cell.find('a') else ""
-                # 标准化名称：将"・"替换为"·"
-                name_cn = name_cn.replace("・", "·")
-                
-                # 提取宝具色卡和类型
-                np_cell = cells[3]
-                np_card_img = np_cell.find('img')
-                np_card = "未知"
-                if np_card_img and 'src' in np_card_img.attrs:
-                    src = np_card_img['src']
-                    if 'Arts' in src:
-                        np_card = "Arts"
-                    elif 'Buster' in src:
-                        np_card = "Buster"
-                    elif 'Quick' in src:
-                        np_card = "Quick"
-                
-                np_type = np_cell.find('b').get_text().strip() if np_cell.find('b') else "未知"
-                
-                # 提取职阶
-                class_cell = cells[4]
-                class_img = class_cell.find('img')
-                servant_class = "未知"
-                class_rarity = "未知"
-                
-                if class_img and 'src' in class_img.attrs:
-                    src = class_img['src']
-                    class_match = re.search(r'(金|银|铜)卡(.+?)\.png', src)
-                    if class_match:
-                        rarity_prefix, class_name = class_match.groups()
-                        servant_class = class_name
-                        
-                        # 根据图片URL中的前缀确定稀有度
-                        if rarity_prefix == "金":
-                            class_rarity = "5星"  # 假设金卡是5星
-                        elif rarity_prefix == "银":
-                            class_rarity = "3星"
-                        elif rarity_prefix == "铜":
-                            class_rarity = "1星"
-                
-                # 提取获取途径
-                obtain = cells[7].get_text().strip()
-                
-                # 只有当名称不为空时才添加
-                if name_cn:
-                    fgo_data[name_cn] = {
-                        "id": servant_id,
-                        "稀有度": class_rarity,
-                        "职阶": servant_class,
-                        "宝具色卡": np_card,
-                        "宝具类型": np_type,
-                        "获取途径": obtain
-                    }
-                    
-                    # 打印一些已提取的从者数据
-                    if len(fgo_data) <= 5 or len(fgo_data) % 50 == 0:
-                        print(f"提取到从者: {name_cn} (ID: {servant_id}), 职阶: {servant_class}, 稀有度: {class_rarity}")
-                    
-            except Exception as e:
-                print(f"解析从者行时出错: {e}")
+    for table_no, table in enumerate(tables, start=1):
+        entries, errors = parse_wiki_table(table, table_no)
+        for error in errors:
+            print(error)
+        _merge_wiki_entries(fgo_data, entries)
     
     # 如果仍未找到数据，查找override_data变量
     if not fgo_data:
@@ -152,6 +212,115 @@ def parse_fgo_wiki_html(soup):
     print(f"从HTML中提取到 {len(fgo_data)} 个从者数据")
     return fgo_data
 
+def find_wikitable_ranges(html_content):
+    """在原始HTML中快速扫描 wikitable 的位置，返回按起始位置排序的 [(起始, 结束), ...]
+
+    跳过 <script>、<style> 和注释中的内容，按嵌套层级匹配 </table>，
+    结果与 soup.find_all('table', class_="wikitable") 的顺序一致。
+    """
+    ranges = []
+    stack = []
+    pos = 0
+    while True:
+        match = _HTML_SCAN_PATTERN.search(html_content, pos)
+        if not match:
+            break
+        pos = match.end()
+        if match.group(0).startswith("<!--"):
+            end = html_content.find("-->", pos)
+            pos = len(html_content) if end < 0 else end + 3
+            continue
+        closing, tag = match.group(1), match.group(2).lower()
+        if tag in ("script", "style"):
+            if not closing:
+                end = re.compile(rf'</{tag}\s*>', re.I).search(html_content, pos)
+                pos = len(html_content) if end is None else end.end()
+            continue
+        if not closing:
+            # 只匹配独立的 class 属性，排除 data-class 等
+            attrs = match.group(0)[len("<table"):]
+            class_match = re.search(r'(?:^|\s)class\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', attrs, re.I)
+            classes = next((group for group in class_match.groups() if group is not None), "") if class_match else ""
+            stack.append((match.start(), "wikitable" in classes.split()))
+        elif stack:
+            start, is_wikitable = stack.pop()
+            if is_wikitable:
+                ranges.append((start, match.end()))
+    # 未闭合的表格一直延续到文档末尾
+    ranges.extend((start, len(html_content)) for start, is_wikitable in stack if is_wikitable)
+    return sorted(ranges)
+
+def _split_wikitable_tasks(html_content, table_no, start, end, rows_per_task=WIKI_ROWS_PER_TASK):
+    """将一个表格拆分为若干按行分块的解析任务 (表格序号, 起始行号, HTML片段)
+
+    表格内含嵌套表格、脚本或注释时不拆分，整表作为一个任务。
+    """
+    fragment = html_content[start:end]
+    open_tag_end = fragment.find(">") + 1
+    inner = fragment[open_tag_end:]
+    row_starts = [m.start() for m in re.finditer(r'<tr\b', inner, re.I)]
+    if (len(row_starts) <= rows_per_task
+            or re.search(r'<table\b|<script\b|<style\b|<!--', inner, re.I)):
+        return [(table_no, 0, fragment)]
+
+    tasks = []
+    open_tag = fragment[:open_tag_end]
+    for first_row_no in range(0, len(row_starts), rows_per_task):
+        # 第一块包含表头之前的内容，最后一块一直到表格结束
+        chunk_start = 0 if first_row_no == 0 else row_starts[first_row_no]
+        next_row_no = first_row_no + rows_per_task
+        chunk_end = row_starts[next_row_no] if next_row_no < len(row_starts) else len(inner)
+        tasks.append((table_no, first_row_no, f"{open_tag}{inner[chunk_start:chunk_end]}</table>"))
+    return tasks
+
+def _parse_wikitable_fragment(task):
+    """进程池任务：解析一个表格（或其中一段行）的HTML片段"""
+    table_no, first_row_no, fragment = task
+    table = BeautifulSoup(fragment, 'html.parser').find('table')
+    if table is None:
+        return [], [f"第 {table_no} 个表格解析失败: 未找到 <table> 标签"]
+    return parse_wiki_table(table, table_no, first_row_no)
+
+def parse_fgo_wiki_html_parallel(html_content, workers=None):
+    """使用进程池并行解析原始HTML中的各个 wikitable
+
+    结果按文档顺序合并，同名从者的覆盖规则与 parse_fgo_wiki_html 相同；
+    未扫描到表格时回退为串行解析（包括 override_data 的处理）。
+    """
+    print("开始并行解析FGO Wiki HTML数据...")
+    ranges = find_wikitable_ranges(html_content)
+    if not ranges:
+        print("未扫描到从者表格，改为串行解析")
+        return parse_fgo_wiki_html(BeautifulSoup(html_content, 'html.parser'))
+
+    tasks = []
+    for table_no, (start, end) in enumerate(ranges, start=1):
+        tasks.extend(_split_wikitable_tasks(html_content, table_no, start, end))
+    print(f"找到 {len(ranges)} 个从者表格，拆分为 {len(tasks)} 个解析任务")
+
+    fgo_data = {}
+    # 主流程在线程池中调用本函数，从多线程进程 fork 子进程可能死锁，因此不使用 fork
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method)) as executor:
+        # map 按提交顺序返回结果，保证合并顺序与文档顺序一致
+        for entries, errors in executor.map(_parse_wikitable_fragment, tasks):
+            for error in errors:
+                print(error)
+            _merge_wiki_entries(fgo_data, entries)
+
+    print(f"从HTML中提取到 {len(fgo_data)} 个从者数据")
+    return fgo_data
+
+def load_local_html(file_path):
+    """读取本地HTML文件的原始内容，失败时返回 None"""
+    try:
+        print(f"正在从本地文件加载: {file_path}")
+        with open(file_path, 'r', encoding='utf-8') as file:
+            return file.read()
+    except Exception as e:
+        print(f"错误: 读取本地文件时发生错误: {e}")
+        return None
+
 def scrape_bangumi(mapping_file_path):
     """从本地 JSON 文件加载 Bangumi 角色名称到 ID 的映射"""
     print(f"开始加载 Bangumi 映射文件: {mapping_file_path}")
@@ -240,7 +409,7 @@ def standardize_name(name):
     
     return name
 
-def load_servant_aliases(file_path="fgo_servant_aliases.json"):
+def load_servant_aliases(file_path=SERVANT_ALIASES_FILE):
     """加载从者别名映射"""
     print(f"开始加载从者别名映射: {file_path}")
     aliases_map = {}
@@ -271,33 +440,60 @@ def load_servant_aliases(file_path="fgo_servant_aliases.json"):
     return aliases_map, inverse_aliases_map
 
 # --- 数据处理与映射 ---
-def find_bangumi_id(fgo_name, bangumi_map, bangumi_characters=None, characters_by_id=None, aliases_map=None, inverse_aliases_map=None):
-    """根据 FGO 从者名称查找对应的 Bangumi ID，使用扩展匹配算法"""
+def build_match_index(bangumi_map, bangumi_characters=None):
+    """预先标准化 Bangumi 名称，供 find_bangumi_id 反复查询
+
+    精确匹配使用字典（保留映射中第一次出现的ID），其余需要逐条比较的步骤使用列表。
+    """
+    exact = {}
+    lower = {}
+    names = []
+    raw_names = []
+    for bgm_name, bgm_id in bangumi_map.items():
+        normalized_bgm_name = standardize_name(bgm_name.strip())
+        exact.setdefault(normalized_bgm_name, bgm_id)
+        lower.setdefault(standardize_name(bgm_name).lower().strip(), bgm_id)
+        names.append((normalized_bgm_name, bgm_id))
+        raw_names.append((standardize_name(bgm_name), bgm_id))
+
+    characters = {}
+    for bgm_name, bgm_id in (bangumi_characters or {}).items():
+        characters.setdefault(standardize_name(bgm_name.strip()), bgm_id)
+
+    return {
+        "exact": exact,
+        "characters": characters,
+        "lower": lower,
+        "names": names,
+        "raw_names": raw_names,
+    }
+
+def find_bangumi_id(fgo_name, bangumi_map, bangumi_characters=None, characters_by_id=None, aliases_map=None, inverse_aliases_map=None, match_index=None):
+    """根据 FGO 从者名称查找对应的 Bangumi ID，使用扩展匹配算法
+
+    批量匹配时应传入 build_match_index 预先构建的 match_index，避免每次重新标准化全部名称。
+    """
+    if match_index is None:
+        match_index = build_match_index(bangumi_map, bangumi_characters)
+
     # 首先标准化FGO名称
     normalized_fgo_name = standardize_name(fgo_name.strip())
     
     # 1. 直接精确匹配
-    for bgm_name, bgm_id in bangumi_map.items():
-        normalized_bgm_name = standardize_name(bgm_name.strip())
-        if normalized_fgo_name == normalized_bgm_name:
-            return bgm_id
+    if normalized_fgo_name in match_index["exact"]:
+        return match_index["exact"][normalized_fgo_name]
     
     # 2. 使用Bangumi角色数据进行匹配
-    if bangumi_characters:
-        for bgm_name, bgm_id in bangumi_characters.items():
-            normalized_bgm_name = standardize_name(bgm_name.strip())
-            if normalized_fgo_name == normalized_bgm_name:
-                return bgm_id
+    if normalized_fgo_name in match_index["characters"]:
+        return match_index["characters"][normalized_fgo_name]
     
     # 3. 使用别名映射进行匹配
     if inverse_aliases_map and normalized_fgo_name in inverse_aliases_map:
         original_name = inverse_aliases_map[normalized_fgo_name]
         normalized_original_name = standardize_name(original_name)
         # 使用原始名称尝试匹配
-        for bgm_name, bgm_id in bangumi_map.items():
-            normalized_bgm_name = standardize_name(bgm_name.strip())
-            if normalized_original_name == normalized_bgm_name:
-                return bgm_id
+        if normalized_original_name in match_index["exact"]:
+            return match_index["exact"][normalized_original_name]
     
     # 4. 使用从者的别名尝试匹配
     if aliases_map and normalized_fgo_name in aliases_map:
@@ -307,16 +503,13 @@ def find_bangumi_id(fgo_name, bangumi_map, bangumi_characters=None, characters_b
                 continue
             normalized_alias = standardize_name(alias.strip())
             # 使用别名尝试匹配
-            for bgm_name, bgm_id in bangumi_map.items():
-                normalized_bgm_name = standardize_name(bgm_name.strip())
-                if normalized_alias == normalized_bgm_name:
-                    return bgm_id
+            if normalized_alias in match_index["exact"]:
+                return match_index["exact"][normalized_alias]
     
     # 5. 不区分大小写的匹配
     normalized_fgo_name_lower = normalized_fgo_name.lower()
-    for bgm_name, bgm_id in bangumi_map.items():
-        if normalized_fgo_name_lower == standardize_name(bgm_name).lower().strip():
-            return bgm_id
+    if normalized_fgo_name_lower in match_index["lower"]:
+        return match_index["lower"][normalized_fgo_name_lower]
     
     # 6. 处理名称中包含职阶或特殊标记的情况
     # 例如: "阿尔托莉雅·潘德拉贡(Saber)" -> "阿尔托莉雅·潘德拉贡"
@@ -336,8 +529,7 @@ def find_bangumi_id(fgo_name, bangumi_map, bangumi_characters=None, characters_b
         suffix = parts[1].strip()  # 获取第一个后缀
     
     # 使用纯名称和后缀组合进行匹配
-    for bgm_name, bgm_id in bangumi_map.items():
-        normalized_bgm_name = standardize_name(bgm_name.strip())
+    for normalized_bgm_name, bgm_id in match_index["names"]:
         # 精确匹配纯名称
         if pure_name == normalized_bgm_name:
             return bgm_id
@@ -377,8 +569,7 @@ def find_bangumi_id(fgo_name, bangumi_map, bangumi_characters=None, characters_b
     # 检查是否为特殊情况中的一种
     for fgo_alias, bgm_name in special_cases.items():
         if fgo_alias in normalized_fgo_name:
-            for real_bgm_name, bgm_id in bangumi_map.items():
-                normalized_real_bgm_name = standardize_name(real_bgm_name)
+            for normalized_real_bgm_name, bgm_id in match_index["raw_names"]:
                 if bgm_name in normalized_real_bgm_name:
                     return bgm_id
     
@@ -391,8 +582,7 @@ def find_bangumi_id(fgo_name, bangumi_map, bangumi_characters=None, characters_b
         best_match = None
         best_score = 0
         
-        for bgm_name, bgm_id in bangumi_map.items():
-            normalized_bgm_name = standardize_name(bgm_name.strip())
+        for normalized_bgm_name, bgm_id in match_index["names"]:
             # 计算编辑距离相似度
             dist = Levenshtein.ratio(normalized_fgo_name, normalized_bgm_name)
             if dist > similarity_threshold and dist > best_score:
@@ -406,8 +596,7 @@ def find_bangumi_id(fgo_name, bangumi_map, bangumi_characters=None, characters_b
         pass
     
     # 9. 尝试部分匹配（如果前面的方法都失败）
-    for bgm_name, bgm_id in bangumi_map.items():
-        normalized_bgm_name = standardize_name(bgm_name.strip())
+    for normalized_bgm_name, bgm_id in match_index["names"]:
         # 如果 FGO 名称是 Bangumi 名称的一部分，或者 Bangumi 名称是 FGO 名称的一部分
         if normalized_fgo_name in normalized_bgm_name or normalized_bgm_name in normalized_fgo_name:
             return bgm_id
@@ -415,8 +604,222 @@ def find_bangumi_id(fgo_name, bangumi_map, bangumi_characters=None, characters_b
     # 所有方法都失败，返回 None
     return None
 
-def format_output_data(bangumi_id, fgo_details, characters_by_id=None):
-    """将 FGO 数据格式化为最终输出的 JSON 结构，按照用户要求的格式"""
+# --- 静态资源构建 ---
+def _content_hash(data):
+    """返回内容哈希的前若干位，用于生成带缓存校验的文件名"""
+    return hashlib.sha256(data).hexdigest()[:ASSET_HASH_LENGTH]
+
+def _hashed_name(file_name, digest):
+    """在扩展名前插入内容哈希，例如 Arts.png -> Arts.1a2b3c4d5e.png"""
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}.{digest}{ext}"
+
+def _sprite_class_name(rel_path):
+    """根据图标相对路径生成雪碧图CSS类名，例如 Class/金卡Lancer.png -> fgo-class-gold-lancer"""
+    group, file_name = rel_path.split("/", 1)
+    stem = os.path.splitext(file_name)[0]
+    if group == "Class":
+        for prefix, tier in (("金卡", "gold"), ("银卡", "silver"), ("铜卡", "bronze")):
+            if stem.startswith(prefix):
+                return f"fgo-class-{tier}-{stem[len(prefix):].lower()}"
+    if group == "Color":
+        return f"fgo-card-{stem.lower()}"
+    return f"fgo-{group.lower()}-{stem.lower()}"
+
+def _pack_sprite_icons(sizes, max_width=ASSET_SPRITE_MAX_WIDTH):
+    """按行排布图标（先放高的），返回 ({相对路径: (x, y)}, 总宽, 总高)"""
+    positions = {}
+    x = y = row_height = width = 0
+    for rel_path, (w, h) in sorted(sizes.items(), key=lambda item: (-item[1][1], item[0])):
+        if x and x + w > max_width:
+            y += row_height
+            x = row_height = 0
+        positions[rel_path] = (x, y)
+        x += w
+        row_height = max(row_height, h)
+        width = max(width, x)
+    return positions, width, y + row_height
+
+def _manifest_asset_paths(manifest, dist_dir, dist_url):
+    """返回资源清单中引用的、位于输出目录内的文件路径集合"""
+    if not manifest:
+        return set()
+    urls = [entry.get("url") for entry in manifest.get("icons", {}).values()]
+    urls += [url for key, url in manifest.get("sprite", {}).items() if key in ("png", "webp", "css")]
+    paths = set()
+    for url in urls:
+        if url and url.startswith(f"{dist_url}/"):
+            paths.add(os.path.normpath(os.path.join(dist_dir, *url[len(dist_url) + 1:].split("/"))))
+    return paths
+
+def _write_asset(path, data, written):
+    """写出构建产物并记录路径，构建失败时据此清理"""
+    with open(path, 'wb') as f:
+        f.write(data)
+    written.add(os.path.normpath(path))
+
+def _read_previous_manifest(dist_dir):
+    """读取上一次构建的资源清单，不存在或无法解析时返回 None"""
+    try:
+        with open(os.path.join(dist_dir, ASSET_MANIFEST_NAME), 'r', encoding='utf-8-sig') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def build_tag_assets(asset_dir=ASSET_DIR, dist_dir=ASSET_DIST_DIR, dist_url=ASSET_DIST_URL, webp=False):
+    """为职阶与色卡图标生成带内容哈希的文件、雪碧图及对应CSS，并写出资源清单
+
+    哈希文件只需标准库；雪碧图需要安装 Pillow，未安装时跳过并仅输出哈希文件。
+    返回写入清单的数据。
+    """
+    print(f"开始构建图标资源: {asset_dir} -> {dist_dir}")
+    dist_url = dist_url.rstrip("/")
+    # 旧文件在新清单写入之后才删除，构建中途失败时旧清单引用的文件仍然可用
+    previous_paths = _manifest_asset_paths(_read_previous_manifest(dist_dir), dist_dir, dist_url)
+    manifest = {"icons": {}}
+
+    icon_files = []
+    for group in ASSET_ICON_GROUPS:
+        group_dir = os.path.join(asset_dir, group)
+        if not os.path.isdir(group_dir):
+            print(f"图标目录不存在，跳过: {group_dir}")
+            continue
+        for file_name in sorted(os.listdir(group_dir)):
+            if file_name.lower().endswith(".png"):
+                icon_files.append((f"{group}/{file_name}", os.path.join(group_dir, file_name)))
+
+    written = set()
+    try:
+        # 1. 复制带内容哈希的单个图标
+        for rel_path, src_path in icon_files:
+            with open(src_path, 'rb') as f:
+                data = f.read()
+            group, file_name = rel_path.split("/", 1)
+            hashed_rel_path = f"{group}/{_hashed_name(file_name, _content_hash(data))}"
+            os.makedirs(os.path.join(dist_dir, group), exist_ok=True)
+            _write_asset(os.path.join(dist_dir, hashed_rel_path), data, written)
+            manifest["icons"][rel_path] = {"url": f"{dist_url}/{hashed_rel_path}"}
+        print(f"已生成 {len(icon_files)} 个带哈希的图标文件")
+
+        # 2. 拼合雪碧图
+        try:
+            from PIL import Image
+        except ImportError:
+            Image = None
+            print("未安装 Pillow，跳过雪碧图生成（仅可使用哈希URL模式）")
+
+        if Image and icon_files:
+            images = {}
+            for rel_path, src_path in icon_files:
+                with Image.open(src_path) as img:
+                    images[rel_path] = img.convert("RGBA")
+            positions, width, height = _pack_sprite_icons({p: img.size for p, img in images.items()})
+            sheet = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+            for rel_path, img in images.items():
+                sheet.paste(img, positions[rel_path])
+
+            def save_sheet(fmt, ext, **options):
+                buffer = io.BytesIO()
+                sheet.save(buffer, fmt, **options)
+                data = buffer.getvalue()
+                file_name = _hashed_name(f"{ASSET_SPRITE_NAME}.{ext}", _content_hash(data))
+                _write_asset(os.path.join(dist_dir, file_name), data, written)
+                return file_name
+
+            sprite_png = save_sheet("PNG", "png", optimize=True)
+            sprite_webp = None
+            if webp:
+                try:
+                    sprite_webp = save_sheet("WEBP", "webp", lossless=True, method=6)
+                except (KeyError, OSError, ValueError) as e:
+                    # Pillow 可能未编译 WebP 支持
+                    print(f"生成 WebP 雪碧图失败，仅输出 PNG: {e}")
+
+            # 图片与CSS同目录，CSS中使用相对路径引用
+            if sprite_webp:
+                background = (f"  background-image: url({sprite_png});\n"
+                              f"  background-image: image-set(url({sprite_webp}) type(\"image/webp\"), "
+                              f"url({sprite_png}) type(\"image/png\"));\n")
+            else:
+                background = f"  background-image: url({sprite_png});\n"
+            css_lines = [f".fgo-icon {{\n  display: inline-block;\n  vertical-align: middle;\n"
+                         f"  background-repeat: no-repeat;\n{background}}}"]
+            for rel_path, img in images.items():
+                class_name = _sprite_class_name(rel_path)
+                x, y = positions[rel_path]
+                w, h = img.size
+                css_lines.append(f".{class_name} {{ width: {w}px; height: {h}px; "
+                                 f"background-position: {-x}px {-y}px; }}")
+                manifest["icons"][rel_path].update({"class": class_name, "x": x, "y": y, "width": w, "height": h})
+            css = ("\n".join(css_lines) + "\n").encode("utf-8")
+            css_name = _hashed_name(f"{ASSET_SPRITE_NAME}.css", _content_hash(css))
+            _write_asset(os.path.join(dist_dir, css_name), css, written)
+
+            manifest["sprite"] = {
+                "png": f"{dist_url}/{sprite_png}",
+                "css": f"{dist_url}/{css_name}",
+                "width": width,
+                "height": height,
+            }
+            if sprite_webp:
+                manifest["sprite"]["webp"] = f"{dist_url}/{sprite_webp}"
+            print(f"已生成雪碧图 {sprite_png}（{width}x{height}）及样式表 {css_name}")
+
+        manifest_file = os.path.join(dist_dir, ASSET_MANIFEST_NAME)
+        os.makedirs(dist_dir, exist_ok=True)
+        temp_file = f"{manifest_file}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, manifest_file)
+        print(f"资源清单已写入: {manifest_file}")
+    except BaseException:
+        # 构建失败时删除本次新写出的文件，保留旧清单及其引用的文件
+        for path in written - previous_paths:
+            if os.path.isfile(path):
+                os.remove(path)
+        raise
+
+    # 删除上一次构建中不再被新清单引用的文件
+    removed = 0
+    for path in previous_paths - _manifest_asset_paths(manifest, dist_dir, dist_url):
+        if os.path.isfile(path):
+            os.remove(path)
+            removed += 1
+    if removed:
+        print(f"已删除上一次构建的 {removed} 个文件")
+    return manifest
+
+def load_asset_manifest(manifest_file=ASSET_MANIFEST_FILE):
+    """加载图标资源清单，文件不存在或解析失败时返回 None"""
+    try:
+        with open(manifest_file, 'r', encoding='utf-8-sig') as f:
+            manifest = json.load(f)
+        print(f"成功加载图标资源清单，共 {len(manifest.get('icons', {}))} 个图标")
+        return manifest
+    except FileNotFoundError:
+        print(f"图标资源清单不存在: {manifest_file}，请先运行 build-assets")
+    except json.JSONDecodeError as e:
+        print(f"错误: 解析图标资源清单失败: {manifest_file} - {e}")
+    return None
+
+def render_tag_icon(rel_path, alt, asset_manifest=None, icon_mode="path"):
+    """生成图标标签
+
+    icon_mode 为 "path" 时使用原始图片路径；"hashed" 时使用清单中带哈希的URL；
+    "sprite" 时输出雪碧图CSS类。清单中缺少对应条目时逐级回退。
+    """
+    entry = (asset_manifest or {}).get("icons", {}).get(rel_path, {})
+    if icon_mode == "sprite" and "class" in entry:
+        return f"<span class='fgo-icon {entry['class']}' role='img' aria-label='{alt}'></span>"
+    if icon_mode in ("hashed", "sprite") and "url" in entry:
+        return f"<img src='{entry['url']}' alt='{alt}' />"
+    return f"<img src='{ASSET_URL_PREFIX}/{rel_path}' alt='{alt}' />"
+
+def format_output_data(bangumi_id, fgo_details, characters_by_id=None, asset_manifest=None, icon_mode="path"):
+    """将 FGO 数据格式化为最终输出的 JSON 结构，按照用户要求的格式
+
+    icon_mode 与 asset_manifest 决定图标的输出方式，参见 render_tag_icon。
+    """
     
     # 处理稀有度 - 直接使用文本而非图片
     rarity = fgo_details.get("稀有度", "未知")
@@ -455,10 +858,10 @@ def format_output_data(bangumi_id, fgo_details, characters_by_id=None):
     else:  # 1星、2星或未知
         rarity_prefix = "铜卡"
     
-    # 使用原始职阶图标的路径
-    img_path = f"/assets/tag/fgo/Class/{rarity_prefix}{servant_class}.png"
+    # 使用原始职阶图标（或其哈希/雪碧图版本）
+    class_icon = render_tag_icon(f"Class/{rarity_prefix}{servant_class}.png", class_display, asset_manifest, icon_mode)
     class_val = {
-        class_display: f"<img src='{img_path}' alt='{class_display}' /> {class_display}"
+        class_display: f"{class_icon} {class_display}"
     }
 
     # 处理宝具色卡
@@ -469,8 +872,9 @@ def format_output_data(bangumi_id, fgo_details, characters_by_id=None):
         "Buster": "红卡"
     }
     display_text = np_card_display_map.get(np_card, np_card)
+    np_card_icon = render_tag_icon(f"Color/{np_card}.png", display_text, asset_manifest, icon_mode)
     np_card_val = {
-        display_text: f"<img src='/assets/tag/fgo/Color/{np_card}.png' alt='{display_text}' /> {display_text}"
+        display_text: f"{np_card_icon} {display_text}"
     }
 
     # 处理宝具类型 (直接使用文本)
@@ -587,41 +991,78 @@ def print_all_servants(fgo_data, output_file="all_fgo_servants.json"):
     
     return formatted_data
 
-# --- 主程序 ---
-if __name__ == "__main__":
-    print("开始执行脚本...")
+# --- 流水线执行 ---
+def run_pipeline(stages, max_workers=None):
+    """按声明的依赖关系并发执行各个阶段，返回 {阶段名称: 结果}
 
-    # 1. 从本地HTML文件加载FGO Wiki数据
-    fgo_soup = get_soup(FGO_WIKI_LOCAL_FILE, use_local=True)
-    fgo_servants_data = {}
-    if fgo_soup:
-        fgo_servants_data = parse_fgo_wiki_html(fgo_soup)
-        
-        # 添加：输出所有从者数据
-        print_all_servants(fgo_servants_data, ALL_SERVANTS_FILE)
+    stages 为 {阶段名称: (函数, (依赖阶段, ...))}，函数以依赖阶段的结果作为位置参数调用。
+    某个阶段的全部依赖完成后立即提交到线程池，互不依赖的阶段同时运行；
+    依赖缺失或存在环时在执行前抛出 ValueError，阶段出错时抛出 RuntimeError。
+    """
+    for name, (_, deps) in stages.items():
+        missing = [dep for dep in deps if dep not in stages]
+        if missing:
+            raise ValueError(f"阶段 {name} 依赖未定义的阶段: {missing}")
+    # 拓扑排序检查依赖环
+    remaining = {name: set(deps) for name, (_, deps) in stages.items()}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            raise ValueError(f"阶段之间存在循环依赖: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+    results = {}
+    pending = dict(stages)
+    running = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1) as executor:
+        while pending or running:
+            for name, (func, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    del pending[name]
+                    stage_started = time.perf_counter()
+                    future = executor.submit(func, *[results[dep] for dep in deps])
+                    running[future] = (name, stage_started)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, stage_started = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    # 不再提交新阶段，等待已在运行的阶段结束后退出
+                    pending.clear()
+                    wait(running)
+                    raise RuntimeError(f"阶段 {name} 执行失败: {error}") from error
+                results[name] = future.result()
+                print(f"[流水线] 阶段 {name} 完成，用时 {time.perf_counter() - stage_started:.2f} 秒")
+
+    print(f"[流水线] 全部 {len(stages)} 个阶段完成，总用时 {time.perf_counter() - started:.2f} 秒")
+    return results
+
+def load_wiki_servants(workers=1):
+    """从本地HTML文件加载FGO Wiki数据，文件无法加载时返回 None"""
+    if workers == 1:
+        fgo_soup = get_soup(FGO_WIKI_LOCAL_FILE, use_local=True)
+        if fgo_soup:
+            return parse_fgo_wiki_html(fgo_soup)
     else:
-        print("未能加载本地HTML文件，使用测试数据。")
-        fgo_servants_data = create_test_data(bangumi_character_map)
-        
-        # 即使使用测试数据，也输出所有从者
-        print_all_servants(fgo_servants_data, ALL_SERVANTS_FILE)
+        html_content = load_local_html(FGO_WIKI_LOCAL_FILE)
+        if html_content is not None:
+            return parse_fgo_wiki_html_parallel(html_content, workers or None)
+    return None
 
-    # 2. 加载Bangumi ID映射文件
-    bangumi_character_map = scrape_bangumi(BANGUMI_MAPPING_FILE)
-    
-    # 3. 加载Bangumi角色详细数据
-    bangumi_characters, characters_by_id = load_bangumi_characters(BANGUMI_CHARACTERS_FILE)
-    
-    # 4. 加载从者别名数据
-    aliases_map, inverse_aliases_map = load_servant_aliases("fgo_servant_aliases.json")
-    
-    # 输出匹配前的数据统计
-    print(f"\n从Wiki提取的从者数: {len(fgo_servants_data)}")
-    print(f"Bangumi映射条目数: {len(bangumi_character_map)}")
-    print(f"Bangumi角色数据条目数: {len(bangumi_characters)}")
-    print(f"从者别名映射数: {len(aliases_map)}")
-    
-    # 检查特定问题角色
+def resolve_servants_data(wiki_servants, bangumi_character_map):
+    """Wiki数据加载失败时根据Bangumi映射生成测试数据"""
+    if wiki_servants is not None:
+        return wiki_servants
+    print("未能加载本地HTML文件，使用测试数据。")
+    return create_test_data(bangumi_character_map)
+
+def report_problem_servants(fgo_servants_data, bangumi_character_map):
+    """检查特定问题角色在Wiki数据与Bangumi映射中的匹配情况"""
     problem_servants = ["玛修·基列莱特", "多布雷尼亚・尼基季奇", "太空伊什塔尔", "武藏坊弁庆", 
                         "克里斯汀", "丝卡蒂", "格里戈里·拉斯普京"]
     for servant in problem_servants:
@@ -641,7 +1082,9 @@ if __name__ == "__main__":
         else:
             print(f"  在Bangumi映射中未找到: {servant} 或 {standardized_name}")
 
-    # 5. 映射并整合数据
+def match_servants(fgo_servants_data, bangumi_character_map, bangumi_characters, characters_by_id,
+                   aliases_map, inverse_aliases_map, match_index, asset_manifest=None, icon_mode="path"):
+    """映射并整合数据，返回 (最终输出数据, 未匹配从者列表, 已使用的Bangumi名称集合)"""
     print("\n开始映射数据并生成最终结果...")
     final_output_data = {}
     mapped_count = 0
@@ -649,73 +1092,80 @@ if __name__ == "__main__":
     # 用于跟踪已使用的Bangumi条目
     used_bangumi_entries = set()
 
-    if fgo_servants_data and bangumi_character_map:
-        for fgo_name, fgo_details in fgo_servants_data.items():
-            # 使用改进的匹配算法查找Bangumi ID
-            bangumi_id = find_bangumi_id(fgo_name, bangumi_character_map, bangumi_characters, characters_by_id, aliases_map, inverse_aliases_map)
-            
-            if bangumi_id:
-                final_output_data[bangumi_id] = format_output_data(bangumi_id, fgo_details, characters_by_id)
-                mapped_count += 1
-                # 记录已使用的Bangumi条目
-                standardized_name = standardize_name(fgo_name)
-                used_bangumi_entries.add(standardized_name)
-            else:
-                unmapped_fgo_names.append((fgo_name, fgo_details))
+    if not (fgo_servants_data and bangumi_character_map):
+        print("由于未能成功加载数据，无法进行映射。")
+        return final_output_data, unmapped_fgo_names, used_bangumi_entries
+
+    for fgo_name, fgo_details in fgo_servants_data.items():
+        # 使用改进的匹配算法查找Bangumi ID
+        bangumi_id = find_bangumi_id(fgo_name, bangumi_character_map, bangumi_characters, characters_by_id,
+                                     aliases_map, inverse_aliases_map, match_index)
         
-        print(f"数据映射完成。成功映射 {mapped_count} / {len(fgo_servants_data)} 个FGO从者。")
-        if unmapped_fgo_names:
-            print(f"有 {len(unmapped_fgo_names)} 个从者未能找到对应的Bangumi ID")
-            if len(unmapped_fgo_names) <= 10:
-                print("未映射的从者: " + ", ".join([name for name, _ in unmapped_fgo_names]))
-            else:
-                print("前10个未映射从者: " + ", ".join([name for name, _ in unmapped_fgo_names[:10]]) + "...")
-            
-            # 将未匹配的从者信息输出到文件
-            try:
-                unmapped_output_file = UNMAPPED_SERVANTS_FILE
-                unmapped_data = {name: details for name, details in unmapped_fgo_names}
-                
-                with open(unmapped_output_file, 'w', encoding='utf-8') as f:
-                    json.dump(unmapped_data, f, ensure_ascii=False, indent=2)
-                print(f"已将 {len(unmapped_fgo_names)} 个未匹配从者信息写入文件: {unmapped_output_file}")
-            except Exception as e:
-                print(f"写入未匹配从者信息文件时出错: {e}")
+        if bangumi_id:
+            final_output_data[bangumi_id] = format_output_data(bangumi_id, fgo_details, characters_by_id,
+                                                               asset_manifest, icon_mode)
+            mapped_count += 1
+            # 记录已使用的Bangumi条目
+            standardized_name = standardize_name(fgo_name)
+            used_bangumi_entries.add(standardized_name)
+        else:
+            unmapped_fgo_names.append((fgo_name, fgo_details))
+    
+    print(f"数据映射完成。成功映射 {mapped_count} / {len(fgo_servants_data)} 个FGO从者。")
+    if unmapped_fgo_names:
+        print(f"有 {len(unmapped_fgo_names)} 个从者未能找到对应的Bangumi ID")
+        if len(unmapped_fgo_names) <= 10:
+            print("未映射的从者: " + ", ".join([name for name, _ in unmapped_fgo_names]))
+        else:
+            print("前10个未映射从者: " + ", ".join([name for name, _ in unmapped_fgo_names[:10]]) + "...")
+    return final_output_data, unmapped_fgo_names, used_bangumi_entries
+
+def write_unmapped_servants(unmapped_fgo_names, output_file=UNMAPPED_SERVANTS_FILE):
+    """将未匹配的从者信息输出到文件"""
+    if not unmapped_fgo_names:
+        return
+    try:
+        unmapped_data = {name: details for name, details in unmapped_fgo_names}
         
-        # 找出Bangumi映射中未被使用的条目
-        unused_bangumi_entries = []
-        for bgm_name, bgm_id in bangumi_character_map.items():
-            standardized_name = standardize_name(bgm_name)
-            if standardized_name not in used_bangumi_entries:
-                unused_bangumi_entries.append((bgm_name, bgm_id))
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(unmapped_data, f, ensure_ascii=False, indent=2)
+        print(f"已将 {len(unmapped_fgo_names)} 个未匹配从者信息写入文件: {output_file}")
+    except Exception as e:
+        print(f"写入未匹配从者信息文件时出错: {e}")
+
+def write_unused_bangumi_entries(bangumi_character_map, used_bangumi_entries, output_file=UNUSED_BANGUMI_FILE):
+    """找出Bangumi映射中未被使用的条目并输出到文件"""
+    unused_bangumi_entries = []
+    for bgm_name, bgm_id in bangumi_character_map.items():
+        standardized_name = standardize_name(bgm_name)
+        if standardized_name not in used_bangumi_entries:
+            unused_bangumi_entries.append((bgm_name, bgm_id))
+    
+    print(f"\n在Bangumi映射中有 {len(unused_bangumi_entries)} 个条目未在FGO Wiki数据中匹配到")
+    if unused_bangumi_entries:
+        if len(unused_bangumi_entries) <= 10:
+            print("未使用的Bangumi条目: " + ", ".join([f"{name}(ID:{bgm_id})" for name, bgm_id in unused_bangumi_entries]))
+        else:
+            print("前10个未使用的Bangumi条目: " + ", ".join([f"{name}(ID:{bgm_id})" for name, bgm_id in unused_bangumi_entries[:10]]) + "...")
         
-        print(f"\n在Bangumi映射中有 {len(unused_bangumi_entries)} 个条目未在FGO Wiki数据中匹配到")
-        if unused_bangumi_entries:
-            if len(unused_bangumi_entries) <= 10:
-                print("未使用的Bangumi条目: " + ", ".join([f"{name}(ID:{bgm_id})" for name, bgm_id in unused_bangumi_entries]))
-            else:
-                print("前10个未使用的Bangumi条目: " + ", ".join([f"{name}(ID:{bgm_id})" for name, bgm_id in unused_bangumi_entries[:10]]) + "...")
+        try:
+            unused_bgm_data = {name: {"bangumi_id": bgm_id} for name, bgm_id in unused_bangumi_entries}
             
-            # 将未使用的Bangumi条目输出到文件
-            try:
-                unused_bgm_file = UNUSED_BANGUMI_FILE
-                unused_bgm_data = {name: {"bangumi_id": bgm_id} for name, bgm_id in unused_bangumi_entries}
-                
-                with open(unused_bgm_file, 'w', encoding='utf-8') as f:
-                    json.dump(unused_bgm_data, f, ensure_ascii=False, indent=2)
-                print(f"已将 {len(unused_bangumi_entries)} 个未使用的Bangumi条目写入文件: {unused_bgm_file}")
-            except Exception as e:
-                print(f"写入未使用Bangumi条目文件时出错: {e}")
-    else:
-        print("由于未能成功加载数据，无法进行映射。")
+            with open(output_file, 'w', encoding='utf-8') as f:
+                json.dump(unused_bgm_data, f, ensure_ascii=False, indent=2)
+            print(f"已将 {len(unused_bangumi_entries)} 个未使用的Bangumi条目写入文件: {output_file}")
+        except Exception as e:
+            print(f"写入未使用Bangumi条目文件时出错: {e}")
+    return unused_bangumi_entries
 
-    # 6. 输出到JSON文件
-    print(f"\n准备将结果写入文件: {OUTPUT_FILENAME}")
+def write_final_output(final_output_data, output_file=OUTPUT_FILENAME):
+    """将最终结果输出到JSON文件"""
+    print(f"\n准备将结果写入文件: {output_file}")
     if final_output_data:
         try:
-            with open(OUTPUT_FILENAME, 'w', encoding='utf-8') as f:
+            with open(output_file, 'w', encoding='utf-8') as f:
                 json.dump(final_output_data, f, ensure_ascii=False, indent=2)
-            print(f"成功将 {len(final_output_data)} 条数据写入 {OUTPUT_FILENAME}")
+            print(f"成功将 {len(final_output_data)} 条数据写入 {output_file}")
         except IOError as e:
             print(f"错误: 写入JSON文件失败: {e}")
         except Exception as e:
@@ -723,7 +1173,395 @@ if __name__ == "__main__":
     else:
         print("没有可写入的数据。JSON文件未生成。")
 
-    print("脚本执行结束。")
+def build_main_pipeline(args):
+    """主流程的阶段定义：各阶段只依赖声明的输入，互不依赖的加载与解析并发进行"""
+    def load_manifest():
+        return load_asset_manifest(args.asset_manifest) if args.icon_mode != "path" else None
+
+    def report_stats(fgo_servants_data, bangumi_character_map, characters, aliases):
+        # 输出匹配前的数据统计
+        print(f"\n从Wiki提取的从者数: {len(fgo_servants_data)}")
+        print(f"Bangumi映射条目数: {len(bangumi_character_map)}")
+        print(f"Bangumi角色数据条目数: {len(characters[0])}")
+        print(f"从者别名映射数: {len(aliases[0])}")
+        report_problem_servants(fgo_servants_data, bangumi_character_map)
+
+    def match(fgo_servants_data, bangumi_character_map, characters, aliases, match_index, asset_manifest, _report):
+        return match_servants(fgo_servants_data, bangumi_character_map, characters[0], characters[1],
+                              aliases[0], aliases[1], match_index, asset_manifest, args.icon_mode)
 
+    def write_unused(fgo_servants_data, bangumi_character_map, matched):
+        if fgo_servants_data and bangumi_character_map:
+            write_unused_bangumi_entries(bangumi_character_map, matched[2])
+
+    return {
+        # 输入加载：互不依赖，与HTML解析同时进行
+        "wiki": (lambda: load_wiki_servants(args.workers), ()),
+        "mapping": (lambda: scrape_bangumi(BANGUMI_MAPPING_FILE), ()),
+        "characters": (lambda: load_bangumi_characters(BANGUMI_CHARACTERS_FILE), ()),
+        "aliases": (lambda: load_servant_aliases(SERVANT_ALIASES_FILE), ()),
+        "asset_manifest": (load_manifest, ()),
+        # 匹配索引只依赖Bangumi数据，在解析仍在进行时即可构建
+        "match_index": (lambda mapping, characters: build_match_index(mapping, characters[0]),
+                        ("mapping", "characters")),
+        "servants": (resolve_servants_data, ("wiki", "mapping")),
+        # 统计与问题角色诊断先于写出和匹配，避免与其他阶段的输出交错
+        "report": (report_stats, ("servants", "mapping", "characters", "aliases")),
+        "write_all_servants": (lambda servants, _report: print_all_servants(servants, ALL_SERVANTS_FILE),
+                               ("servants", "report")),
+        "match": (match, ("servants", "mapping", "characters", "aliases", "match_index", "asset_manifest", "report")),
+        # 结果写出：互不依赖，并发进行
+        "write_unmapped": (lambda matched: write_unmapped_servants(matched[1]), ("match",)),
+        "write_unused": (write_unused, ("servants", "mapping", "match")),
+        "write_output": (lambda matched: write_final_output(matched[0]), ("match",)),
+    }
 
+# --- 多数据源合并 ---
+def _bangumi_id_sort_key(bangumi_id):
+    """Bangumi ID 的排序键：纯数字ID按数值排序，其余按字符串排在其后"""
+    bangumi_id = str(bangumi_id)
+    if bangumi_id.isdigit():
+        return (0, int(bangumi_id), bangumi_id)
+    return (1, 0, bangumi_id)
 
+_JSON_NUMBER_CHARS = frozenset("0123456789+-.eE")
+
+def iter_json_object_items(file_path, chunk_size=65536):
+    """逐条读取顶层为对象的JSON文件，按文件顺序产出 (键, 值)，不把整个文件读入内存"""
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r', encoding='utf-8-sig') as f:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def fill():
+            # 丢弃已消费的部分并追加下一块内容
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        def skip_ws():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos].isspace():
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return
+                fill()
+
+        def expect(chars):
+            nonlocal pos
+            skip_ws()
+            if pos >= len(buf) or buf[pos] not in chars:
+                found = buf[pos] if pos < len(buf) else "EOF"
+                raise ValueError(f"{file_path}: 期望 {chars!r}，实际为 {found!r}")
+            pos += 1
+            return buf[pos - 1]
+
+        def decode():
+            nonlocal pos
+            skip_ws()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+                    continue
+                # 数字可能在块边界被截断（如 "-1." 或 "1.5e"），其后仍可能是数字的一部分时读到更多内容再解析
+                is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if not eof and (end == len(buf) or (is_number and buf[end] in _JSON_NUMBER_CHARS)):
+                    fill()
+                    continue
+                pos = end
+                return value
+
+        def expect_end():
+            skip_ws()
+            if pos < len(buf):
+                raise ValueError(f"{file_path}: 顶层对象结束后存在多余内容: {buf[pos:pos + 20]!r}")
+
+        fill()
+        expect("{")
+        skip_ws()
+        if pos < len(buf) and buf[pos] == "}":
+            pos += 1
+            expect_end()
+            return
+        while True:
+            key = decode()
+            if not isinstance(key, str):
+                raise ValueError(f"{file_path}: 对象的键必须是字符串，实际为 {key!r}")
+            expect(":")
+            value = decode()
+            yield key, value
+            if expect(",}") == "}":
+                expect_end()
+                return
+
+def iter_servant_source(file_path, presorted=False):
+    """按 Bangumi ID 顺序产出一个数据源中的记录
+
+    presorted 为 True 时流式读取并校验顺序，内存占用只与单条记录有关；
+    否则先整体读入再排序，适用于 fgo_output.json 这类未排序的文件。
+    """
+    if not presorted:
+        with open(file_path, 'r', encoding='utf-8-sig') as f:
+            data = json.load(f)
+        for bangumi_id in sorted(data, key=_bangumi_id_sort_key):
+            yield str(bangumi_id), data[bangumi_id]
+        return
+
+    last_key = None
+    for bangumi_id, record in iter_json_object_items(file_path):
+        sort_key = _bangumi_id_sort_key(bangumi_id)
+        if last_key is not None and sort_key <= last_key:
+            raise ValueError(f"{file_path}: Bangumi ID {bangumi_id} 未按升序排列或重复")
+        last_key = sort_key
+        yield str(bangumi_id), record
+
+def _is_unknown_facet(value):
+    """判断字段值是否为空或仅包含“未知”占位"""
+    if not value:
+        return True
+    if isinstance(value, dict):
+        return all(key in UNKNOWN_FACET_VALUES for key in value)
+    return value in UNKNOWN_FACET_VALUES
+
+def resolve_servant_record(candidates, source_order, field_precedence=None):
+    """按字段优先级合并同一 Bangumi ID 在多个数据源中的记录
+
+    candidates 为 {数据源名称: 记录}，source_order 为默认优先级（靠前者优先），
+    field_precedence 可为个别字段指定单独的优先级列表。
+    返回 (合并后的记录, {字段: 提供该字段的数据源})。
+    """
+    field_precedence = field_precedence or {}
+    fields = list(MERGE_FIELDS)
+    for name in source_order:
+        for field in candidates.get(name, {}):
+            if field not in fields:
+                fields.append(field)
+
+    merged = {}
+    provenance = {}
+    for field in fields:
+        order = field_precedence.get(field, [])
+        order = order + [name for name in source_order if name not in order]
+        fallback = None
+        for name in order:
+            record = candidates.get(name)
+            if record is None or field not in record:
+                continue
+            if not _is_unknown_facet(record[field]):
+                merged[field] = record[field]
+                provenance[field] = name
+                break
+            if fallback is None:
+                fallback = name
+        else:
+            # 所有数据源都是“未知”时保留优先级最高的那一份
+            if fallback is not None:
+                merged[field] = candidates[fallback][field]
+                provenance[field] = fallback
+    return merged, provenance
+
+def _keyed_source_stream(index, file_path, presorted):
+    """为归并堆生成 (排序键, 数据源序号, bangumi_id, 记录)，序号保证同ID时按优先级出堆"""
+    for bangumi_id, record in iter_servant_source(file_path, presorted):
+        yield _bangumi_id_sort_key(bangumi_id), index, bangumi_id, record
+
+def merge_servant_sources(sources, field_precedence=None, presorted=False):
+    """对多个 fgo_output.json 格式的数据源按 Bangumi ID 做多路归并
+
+    sources 为 [(数据源名称, 文件路径), ...]，顺序即默认优先级。
+    逐个产出 (bangumi_id, 合并后的记录, 字段来源)。
+    """
+    source_order = [name for name, _ in sources]
+    streams = [_keyed_source_stream(index, path, presorted) for index, (_, path) in enumerate(sources)]
+
+    current_key = None
+    current_id = None
+    candidates = {}
+    for sort_key, index, bangumi_id, record in heapq.merge(*streams):
+        if sort_key != current_key:
+            if candidates:
+                merged, provenance = resolve_servant_record(candidates, source_order, field_precedence)
+                yield current_id, merged, provenance
+            current_key = sort_key
+            current_id = bangumi_id
+            candidates = {}
+        candidates[source_order[index]] = record
+    if candidates:
+        merged, provenance = resolve_servant_record(candidates, source_order, field_precedence)
+        yield current_id, merged, provenance
+
+class _JsonObjectWriter:
+    """逐条写出顶层为对象的JSON文件，格式与 json.dump(indent=2) 一致
+
+    内容先写入同目录下的临时文件，commit 时才替换目标文件；
+    discard 删除临时文件，保证出错时不会留下截断的结果。
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        fd, self.temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(file_path)}.",
+                                              suffix=".tmp", dir=os.path.dirname(file_path) or ".")
+        self.file = os.fdopen(fd, 'w', encoding='utf-8')
+        self.count = 0
+
+    def write(self, key, value):
+        body = json.dumps(value, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+        prefix = ",\n  " if self.count else "{\n  "
+        self.file.write(f"{prefix}{json.dumps(key, ensure_ascii=False)}: {body}")
+        self.count += 1
+
+    def commit(self):
+        self.file.write("\n}" if self.count else "{}")
+        self.file.close()
+        os.chmod(self.temp_path, self._target_mode())
+        os.replace(self.temp_path, self.file_path)
+
+    def _target_mode(self):
+        """mkstemp 创建的文件权限为 0600；沿用目标文件原有权限，新文件按 umask 设置"""
+        try:
+            return stat.S_IMODE(os.stat(self.file_path).st_mode)
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0o666 & ~umask
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+def parse_source_spec(spec):
+    """解析 “名称=路径” 形式的数据源参数，省略名称时使用文件名"""
+    if "=" in spec:
+        name, path = spec.split("=", 1)
+    else:
+        path = spec
+        name = os.path.splitext(os.path.basename(spec))[0]
+    return name.strip(), path.strip()
+
+def parse_field_precedence(specs):
+    """解析 “字段=来源1,来源2” 形式的字段优先级参数"""
+    field_precedence = {}
+    for spec in specs or []:
+        if "=" not in spec:
+            raise ValueError(f"无效的字段优先级: {spec}（应为 字段=来源1,来源2）")
+        field, names = spec.split("=", 1)
+        field_precedence[field.strip()] = [name.strip() for name in names.split(",") if name.strip()]
+    return field_precedence
+
+def run_merge(sources, output_file=MERGED_OUTPUT_FILENAME, provenance_file=MERGE_PROVENANCE_FILE,
+              field_precedence=None, presorted=False):
+    """合并多个数据源并写出合并结果及字段来源记录"""
+    names = [name for name, _ in sources]
+    if len(set(names)) != len(names):
+        raise ValueError(f"数据源名称重复: {names}")
+    for field, order in (field_precedence or {}).items():
+        unknown = [name for name in order if name not in names]
+        if unknown:
+            raise ValueError(f"字段 {field} 的优先级中包含未知数据源: {unknown}")
+    source_paths = {os.path.abspath(path) for _, path in sources}
+    for target in (output_file, provenance_file):
+        if target and os.path.abspath(target) in source_paths:
+            raise ValueError(f"输出文件不能同时作为数据源: {target}")
+    if provenance_file and os.path.abspath(provenance_file) == os.path.abspath(output_file):
+        raise ValueError(f"合并结果与字段来源记录不能写入同一文件: {output_file}")
+
+    print(f"开始合并 {len(sources)} 个数据源: {', '.join(names)}")
+    writers = [_JsonObjectWriter(output_file)]
+    if provenance_file:
+        writers.append(_JsonObjectWriter(provenance_file))
+    writer = writers[0]
+    conflicts = 0
+    try:
+        for bangumi_id, merged, provenance in merge_servant_sources(sources, field_precedence, presorted):
+            writer.write(bangumi_id, merged)
+            if provenance_file:
+                writers[1].write(bangumi_id, provenance)
+            if len(set(provenance.values())) > 1:
+                conflicts += 1
+    except BaseException:
+        for w in writers:
+            w.discard()
+        raise
+    for w in writers:
+        w.commit()
+
+    print(f"合并完成，共写入 {writer.count} 条数据到 {output_file}，其中 {conflicts} 条由多个数据源共同提供字段")
+    if provenance_file:
+        print(f"字段来源记录已写入 {provenance_file}")
+    return writer.count
+
+def _non_negative_int(value):
+    """argparse 类型：不小于0的整数"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的整数: {value}")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"不能小于0: {value}")
+    return number
+
+def parse_args(argv=None):
+    """解析命令行参数；不带子命令时执行完整的爬取与匹配流程"""
+    parser = argparse.ArgumentParser(description="FGO从者数据爬虫与Bangumi ID匹配系统")
+    parser.add_argument("--icon-mode", choices=ICON_MODES, default="path",
+                        help="输出中职阶/色卡图标的形式：原始路径、带哈希的URL或雪碧图CSS类（默认 path）")
+    parser.add_argument("--workers", type=_non_negative_int, default=1,
+                        help="解析Wiki表格的进程数，不为1时按表格并行解析（0 表示使用全部CPU核心，默认 1）")
+    parser.add_argument("--asset-manifest", default=ASSET_MANIFEST_FILE,
+                        help=f"build-assets 生成的资源清单（默认 {ASSET_MANIFEST_FILE}）")
+    subparsers = parser.add_subparsers(dest="command")
+
+    merge_parser = subparsers.add_parser("merge", help="按 Bangumi ID 合并多个 fgo_output.json 格式的数据源")
+    merge_parser.add_argument("sources", nargs="+", metavar="[名称=]路径",
+                              help="数据源文件，按默认优先级从高到低排列")
+    merge_parser.add_argument("-o", "--output", default=MERGED_OUTPUT_FILENAME,
+                              help=f"合并结果输出文件（默认 {MERGED_OUTPUT_FILENAME}）")
+    merge_parser.add_argument("--provenance", default=MERGE_PROVENANCE_FILE,
+                              help=f"字段来源记录输出文件（默认 {MERGE_PROVENANCE_FILE}，传空字符串则不输出）")
+    merge_parser.add_argument("--prefer", action="append", metavar="字段=来源1,来源2",
+                              help="为单个字段指定数据源优先级，可重复使用")
+    merge_parser.add_argument("--presorted", action="store_true",
+                              help="输入已按 Bangumi ID 升序排列，流式归并以限制内存占用")
+
+    assets_parser = subparsers.add_parser("build-assets", help="生成图标雪碧图、带哈希的图标文件及资源清单")
+    assets_parser.add_argument("--asset-dir", default=ASSET_DIR, help=f"图标源目录（默认 {ASSET_DIR}）")
+    assets_parser.add_argument("--dist-dir", default=ASSET_DIST_DIR, help=f"输出目录（默认 {ASSET_DIST_DIR}）")
+    assets_parser.add_argument("--dist-url", default=ASSET_DIST_URL,
+                               help=f"输出目录对应的站点URL（默认 {ASSET_DIST_URL}）")
+    assets_parser.add_argument("--webp", action="store_true", help="同时生成 WebP 格式的雪碧图")
+    return parser.parse_args(argv)
+
+# --- 主程序 ---
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "merge":
+        try:
+            run_merge(
+                [parse_source_spec(spec) for spec in args.sources],
+                output_file=args.output,
+                provenance_file=args.provenance or None,
+                field_precedence=parse_field_precedence(args.prefer),
+                presorted=args.presorted,
+            )
+        except (ValueError, OSError) as e:
+            # json.JSONDecodeError 是 ValueError 的子类
+            print(f"错误: 合并失败: {e}")
+            sys.exit(1)
+        sys.exit(0)
+    if args.command == "build-assets":
+        build_tag_assets(args.asset_dir, args.dist_dir, args.dist_url, webp=args.webp)
+        sys.exit(0)
+
+    print("开始执行脚本...")
+    run_pipeline(build_main_pipeline(args))
+    print("脚本执行结束。")